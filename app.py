@@ -1,148 +1,170 @@
 import streamlit as st
 import pandas as pd
-from bs4 import BeautifulSoup
+import numpy as np
+from lxml import etree
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from openpyxl import Workbook
+from openpyxl.styles import Border, Font, PatternFill, Side
 import re
+import io
+from itertools import groupby
 
 # --- CONFIGURATION ---
 GOOGLE_SHEET_NAME = "Ninja_Student_Output"
+SKILL_LEVELS = [f"s{n}" for n in range(11)]
+DAYS_ORDER = ["Mon", "Tue", "Wed", "Thu", "Fri", "Lost"]
+EXPORT_COLS = ["Student Name", "Age", "Attend#", "Keyword", "Level", "Class Name", "RS Comment"]
+# Filler rows for the dashboard group blocks
+OPEN_ROWS = pd.DataFrame([{**dict.fromkeys(EXPORT_COLS, ""), "Student Name": "open"}] * 7)
+SPACER_ROW = pd.DataFrame([dict.fromkeys(EXPORT_COLS, "")])
+
+# Row highlight formats
+RED_FMT = {"text_color": {"red": 1.0, "green": 0.0, "blue": 0.0}, "bold": True}
+LIGHT_RED_FMT = {"bg": {"red": 1.0, "green": 0.8, "blue": 0.8}, "bold": False}
+YELLOW_FMT = {"bg": {"red": 1.0, "green": 0.95, "blue": 0.8}, "bold": False}
+GREEN_FMT = {"bg": {"red": 0.85, "green": 0.92, "blue": 0.83}, "bold": False}
+
+# --- PATTERNS ---
+_WS_RE = re.compile(r'\s+')
+_SKILL_RE = re.compile(r'(s(?:[0-9]|10))\b')
+_GROUP_RE = re.compile(r'(group\s*[1-3])')
+_DATE_RE = re.compile(r'\d{1,2}/\d{1,2}/\d{4}.*')
+_DAY_RE = re.compile(r'\b(Mon|Tue|Wed|Thu|Fri)\b', re.IGNORECASE)
+_TIME_RE = re.compile(r'(\d{1,2}):(\d{2})')
+_NUM_RE = re.compile(r'(\d+)')
 
 # VERSION UPDATE: 3.9
 st.set_page_config(page_title="Ninja Park Processor 3.9", page_icon="🥷", layout="wide")
 
 # --- HELPER FUNCTIONS ---
 
-def clean_name(name):
-    """Standardizes names (Title Case, no extra spaces)."""
-    if not isinstance(name, str): return ""
-    clean = re.sub(r'\s+', ' ', name).replace(u'\xa0', ' ').strip()
-    return clean.title()
-
-def abbreviate_class_name(name):
-    """Shortens class names to save space."""
-    if not isinstance(name, str): return name
-    name = re.sub(r'\d{1,2}/\d{1,2}/\d{4}.*', '', name).strip()
-    name = name.replace("Homeschool", "HS")
-    name = name.replace("Flip Side Ninjas", "FS Ninjas")
-    name = name.replace("(Ages ", "(")
-    return name
-
-def parse_class_info(class_name):
-    if not isinstance(class_name, str) or class_name == "Not Found":
-        return "Lost", 9999, ""
-    
-    day_match = re.search(r'\b(Mon|Tue|Wed|Thu|Fri)\b', class_name, re.IGNORECASE)
-    day = day_match.group(1).title() if day_match else "Lost"
-    
-    time_match = re.search(r'(\d{1,2}):(\d{2})', class_name)
-    if time_match:
-        hour = int(time_match.group(1))
-        minute = int(time_match.group(2))
-        if hour < 8: hour += 12 
-        sort_time = hour * 100 + minute
-        time_str = f"{time_match.group(1)}:{time_match.group(2)}"
-    else:
-        sort_time = 9999
-        time_str = ""
-        
-    return day, sort_time, time_str
-
-def parse_skill_number(skill_str):
-    match = re.search(r'(\d+)', str(skill_str))
-    return int(match.group(1)) if match else 0
-
-def parse_group_number(group_str):
-    match = re.search(r'(\d+)', str(group_str))
-    return int(match.group(1)) if match else 99
-
-def parse_attendance(att_str):
-    try: return int(att_str)
-    except: return -1
+def clean_name(names):
+    """Standardizes a Series of names (Title Case, no extra spaces)."""
+    names = names.str.replace(_WS_RE, ' ', regex=True).str.strip()
+    # Exports are mostly Title Case already; only re-case the names that are not
+    needs_title = ~names.str.istitle()
+    return names.mask(needs_title, names[needs_title].str.title())
 
-def parse_age(age_str):
-    match = re.search(r'(\d+)', str(age_str))
-    return int(match.group(1)) if match else 99
+def int_key(values, default):
+    """int32 sort key from numeric text; blanks get the default, huge numbers are capped."""
+    bounds = np.iinfo('int32')
+    nums = pd.to_numeric(values, errors='coerce').fillna(default)
+    return nums.clip(bounds.min, bounds.max).astype('int32')
 
 # --- FILE DETECTION ---
 def identify_file_type(html_content):
     """
     Returns 'roll', 'list', or None based on unique HTML markers.
+    Checks the raw uploaded bytes, so nothing is decoded just to sniff.
     """
-    if 'class="full-width-header"' in html_content or "full-width-header" in html_content:
+    if b"full-width-header" in html_content:
         return 'roll'
     # Student list usually has 'Student Keyword' or specific table structures
-    if 'Student Keyword' in html_content or 'Attendance' in html_content and 'Student Name' in html_content:
+    if b'Student Keyword' in html_content or b'Attendance' in html_content and b'Student Name' in html_content:
         return 'list'
     return None
 
 # --- PARSING LOGIC ---
+_ROWS_XPATH = etree.XPath('.//tr')
+_CELLS_XPATH = etree.XPath('.//td|.//th')
+
+def _cell_text(el):
+    # Most cells hold a single text node; only walk the subtree when they don't
+    if not len(el):
+        return (el.text or "").strip()
+    return "".join(el.itertext()).strip()
+
+def _has_class(el, class_name):
+    classes = el.get("class")
+    # Plain substring test first; only split when it could be a match
+    return classes is not None and class_name in classes and class_name in classes.split()
+
+def _iter_closed(html_content, tags):
+    """
+    Streams elements with the given tags from the uploaded bytes as their
+    closing tag is parsed. Each outermost table is emptied once the caller
+    is done with it, so memory stays around one table rather than the
+    whole document.
+    """
+    source = io.BytesIO(html_content)
+    for _, el in etree.iterparse(source, events=("end",), tag=tags, html=True, encoding="utf-8"):
+        yield el
+        if el.tag == "table" and next(el.iterancestors("table"), None) is None:
+            el.clear(keep_tail=True)
+
+@st.cache_data(show_spinner=False, max_entries=4)
 def parse_roll_sheet(html_content):
-    soup = BeautifulSoup(html_content, 'lxml')
-    data = []
-    headers = soup.find_all('div', class_='full-width-header')
-    
-    if not headers:
-        # Fallback if detection worked but soup failed (unlikely)
-        return pd.DataFrame()
-
-    for header in headers:
-        name_span = header.find('span')
-        class_name_raw = name_span.get_text(strip=True) if name_span else header.get_text(separator=" ", strip=True)
-        current_class_name = class_name_raw if class_name_raw else "Unknown Class"
-        
-        table = header.find_next('table', class_='table-roll-sheet')
-        next_header = header.find_next('div', class_='full-width-header')
-        
-        if table and next_header:
-            h_line = next_header.sourceline
-            t_line = table.sourceline
-            if h_line is not None and t_line is not None and h_line < t_line:
-                continue 
+    names, details, class_names = [], [], []
+    # Class headers seen since the last roll table, in document order
+    pending = []
+
+    for el in _iter_closed(html_content, ("div", "table")):
+        if el.tag == "div":
+            if not _has_class(el, "full-width-header"): continue
+            name_span = el.find('.//span')
+            if name_span is not None:
+                class_name_raw = _cell_text(name_span)
+            else:
+                class_name_raw = " ".join(t.strip() for t in el.itertext() if t.strip())
+            pending.append(class_name_raw if class_name_raw else "Unknown Class")
+            continue
+
+        if not _has_class(el, "table-roll-sheet") or not pending: continue
 
-        if not table: continue
+        # Only the header right before this table owns it; earlier pending
+        # headers had no table of their own and are skipped
+        class_name = pending[-1]
+        pending = []
 
-        rows = table.find_all('tr')
+        rows = _ROWS_XPATH(el)
         if not rows: continue
         
-        first_row_cols = [c.get_text(strip=True) for c in rows[0].find_all(['td', 'th'])]
+        first_row_cols = [_cell_text(c) for c in _CELLS_XPATH(rows[0])]
         name_idx, detail_idx = 1, 3 
         
         for idx, col_text in enumerate(first_row_cols):
             if "Student" in col_text: name_idx = idx
             if "Details" in col_text: detail_idx = idx
             
+        # Short rows are padded so every wanted column can be indexed
+        width = max(name_idx, detail_idx) + 1
+        table_names, table_details = [], []
         for row in rows[1:]:
-            cols = row.find_all(['td', 'th'])
-            def get_val(i): return cols[i].get_text(strip=True) if i < len(cols) else ""
-            
-            raw_name = get_val(name_idx)
-            details_text = get_val(detail_idx).lower()
-            
-            skill_level = "s0"
-            skill_match = re.search(r's([0-9]|10)\b', details_text)
-            if skill_match: skill_level = skill_match.group(0)
-            
-            if raw_name and len(raw_name) > 1 and "Student" not in raw_name:
-                data.append({
-                    "Student Name": clean_name(raw_name),
-                    "Skill Level": skill_level,
-                    "Class Name": current_class_name
-                })
-
-    df = pd.DataFrame(data)
-    if not df.empty: df = df.drop_duplicates(subset=["Student Name"], keep='first')
-    return df
-
+            texts = [_cell_text(c) for c in _CELLS_XPATH(row)]
+            if len(texts) < width: texts += [""] * (width - len(texts))
+            table_names.append(texts[name_idx])
+            table_details.append(texts[detail_idx])
+
+        names.extend(table_names)
+        details.extend(table_details)
+        class_names.extend([class_name] * len(table_names))
+
+    df = pd.DataFrame({"Student Name": names, "Details": details, "Class Name": class_names}, dtype=str)
+    # Blank/one-letter cells and repeated header rows are not students
+    raw_names = df["Student Name"]
+    df = df[(raw_names.str.len() > 1) & ~raw_names.str.contains("Student", regex=False)]
+    # A student enrolled in several classes repeats with the same raw spelling;
+    # drop those first so the cleanup below only runs once per spelling
+    df.drop_duplicates(subset=["Student Name"], keep='first', inplace=True, ignore_index=True)
+    df["Student Name"] = clean_name(df["Student Name"])
+    df["Skill Level"] = pd.Categorical(
+        df["Details"].str.lower().str.extract(_SKILL_RE, expand=False).fillna("s0"), categories=SKILL_LEVELS
+    )
+    df = df[["Student Name", "Skill Level", "Class Name"]]
+    df.drop_duplicates(subset=["Student Name"], keep='first', inplace=True, ignore_index=True)
+    # Indexed by name so the merge with the student list is an index lookup
+    return df.set_index("Student Name")
+
+@st.cache_data(show_spinner=False, max_entries=4)
 def parse_student_list(html_content):
-    soup = BeautifulSoup(html_content, 'lxml')
-    data = []
-    tables = soup.find_all('table')
+    names, ages, attendances, comments, keywords = [], [], [], [], []
     
-    for table in tables:
-        rows = table.find_all('tr')
+    for table in _iter_closed(html_content, ("table",)):
+        rows = _ROWS_XPATH(table)
         if not rows: continue
-        headers = [c.get_text(strip=True).lower() for c in rows[0].find_all(['td', 'th'])]
+        headers = [_cell_text(c).lower() for c in _CELLS_XPATH(rows[0])]
         
         name_idx, att_idx, age_idx, key_idx, comm_idx = 1, 2, 3, 4, 5
         for i, h in enumerate(headers):
@@ -152,113 +174,153 @@ def parse_student_list(html_content):
             elif "attendance" in h: att_idx = i
             elif "comment" in h: comm_idx = i
 
+        # Short rows are padded so every wanted column can be indexed
+        width = max(name_idx, att_idx, age_idx, key_idx, comm_idx) + 1
         for row in rows[1:]:
-            cols = row.find_all(['td', 'th'])
-            def get_val(i): return cols[i].get_text(strip=True) if i < len(cols) else ""
-            
-            raw_name = get_val(name_idx)
-            age = get_val(age_idx)
-            attendance = get_val(att_idx)
-            comment = get_val(comm_idx)
-            keywords_raw = get_val(key_idx).lower()
-            
-            group_match = re.search(r'(group\s*[1-3])', keywords_raw)
-            clean_keyword = group_match.group(0).capitalize() if group_match else ""
-
-            if raw_name and len(raw_name) > 1:
-                data.append({
-                    "Student Name": clean_name(raw_name),
-                    "Age": age,
-                    "Attendance": attendance,
-                    "Roll Sheet Comment": comment,
-                    "Student Keyword": clean_keyword
-                })
+            texts = [_cell_text(c) for c in _CELLS_XPATH(row)]
+            if len(texts) < width: texts += [""] * (width - len(texts))
+            names.append(texts[name_idx])
+            ages.append(texts[age_idx])
+            attendances.append(texts[att_idx])
+            comments.append(texts[comm_idx])
+            keywords.append(texts[key_idx])
     
-    df = pd.DataFrame(data)
-    if not df.empty: df = df.drop_duplicates(subset=["Student Name"])
+    df = pd.DataFrame({
+        "Student Name": names,
+        "Age": ages,
+        "Attendance": attendances,
+        "Roll Sheet Comment": comments,
+        "Student Keyword": keywords
+    }, dtype=str)
+    df = df[df["Student Name"].str.len() > 1]
+    df.drop_duplicates(subset=["Student Name"], keep='first', inplace=True, ignore_index=True)
+    df["Student Name"] = clean_name(df["Student Name"])
+    df["Student Keyword"] = (
+        df["Student Keyword"].str.lower().str.extract(_GROUP_RE, expand=False).fillna("").str.capitalize()
+    ).astype("category")
+    df.drop_duplicates(subset=["Student Name"], keep='first', inplace=True, ignore_index=True)
     return df
 
-# --- FORMATTING & STRUCTURE ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_student_table(df_list, df_roll):
+    """Joins the two parses and adds the day/time and numeric sort columns."""
+    merged_df = df_list[df_list["Student Name"].str.strip().astype(bool)].copy()
+    # The roll sheet is indexed by unique name, so a left join is two lookups
+    names = merged_df["Student Name"]
+    merged_df["Skill Level"] = names.map(df_roll["Skill Level"])
+    merged_df["Class Name"] = names.map(df_roll["Class Name"])
+
+    # Students missing from the roll sheet
+    merged_df = merged_df.fillna({"Skill Level": "s0", "Class Name": "Not Found"})
+
+    # Shorter class names to save space
+    merged_df["Class Name"] = (
+        merged_df["Class Name"].str.replace(_DATE_RE, '', regex=True).str.strip()
+        .str.replace("Homeschool", "HS", regex=False)
+        .str.replace("Flip Side Ninjas", "FS Ninjas", regex=False)
+        .str.replace("(Ages ", "(", regex=False)
+    )
+
+    # Day and start time from the class name; no day means "Lost"
+    class_names = merged_df['Class Name']
+    merged_df['Sort Day'] = pd.Categorical(
+        class_names.str.extract(_DAY_RE, expand=False).str.title().fillna("Lost"), categories=DAYS_ORDER, ordered=True
+    )
+    times = class_names.str.extract(_TIME_RE)
+    hours = pd.to_numeric(times[0])
+    hours = hours.mask(hours < 8, hours + 12)
+    merged_df['Sort Time'] = (hours * 100 + pd.to_numeric(times[1])).fillna(9999).astype('int32')
+    merged_df['Time Str'] = (times[0] + ":" + times[1]).fillna("")
+
+    # Numeric sort/highlight keys, parsed once here instead of per time slot
+    merged_df['_group_num'] = int_key(merged_df['Student Keyword'].str.extract(_NUM_RE, expand=False), 99)
+    merged_df['_skill_num'] = int_key(merged_df['Skill Level'].str.extract(_NUM_RE, expand=False), 0)
+    merged_df['_att_num'] = int_key(merged_df['Attendance'], -1)
+    merged_df['_age_num'] = int_key(merged_df['Age'].str.extract(_NUM_RE, expand=False), 99)
+    merged_df['_is_advanced'] = merged_df['Class Name'].str.lower().str.contains("advanced", regex=False)
+    merged_df['_is_ignored'] = merged_df['Roll Sheet Comment'].str.lower().str.contains("ignore", regex=False)
+
+    return merged_df
 
-def apply_highlight_rules(df_records):
-    formats = [None] * len(df_records)
-    
-    # 1. BASE RULES
-    for i, row in enumerate(df_records):
-        student_name = row.get("Student Name", "")
-        # IGNORE "open" rows and blank rows
-        if not student_name or student_name == "open": continue
-        
-        if "ignore" in str(row.get("RS Comment", "")).lower(): continue
-            
-        skill = parse_skill_number(row.get("Level", "0"))
-        group = parse_group_number(row.get("Keyword", "99"))
-        class_name = str(row.get("Class Name", "")).lower()
-        is_advanced = "advanced" in class_name
-        
-        # RED TEXT (Bold + Red Text)
-        if not is_advanced and skill >= 3:
-            formats[i] = {"text_color": {"red": 1.0, "green": 0.0, "blue": 0.0}, "bold": True}
-            continue
+# --- FORMATTING & STRUCTURE ---
 
-        # LIGHT RED BG (Blank Group)
-        if group == 99:
-            formats[i] = {"bg": {"red": 1.0, "green": 0.8, "blue": 0.8}, "bold": False}
-            continue
+def apply_highlight_rules(block):
+    """Row formats for one slot block; None where the row keeps the default look."""
+    names = block["Student Name"]
+    # Open rows and spacers carry no parsed keys or flags
+    ignore = block["_is_ignored"].eq(True).to_numpy()
+    is_open = (names == "open").to_numpy()
+    # IGNORE "open" rows and blank rows
+    skip = is_open | (names == "").to_numpy() | ignore
 
-        # YELLOW BG
-        is_yellow = False
-        if is_advanced:
-            if group == 1 and skill >= 5: is_yellow = True
-            elif group == 2 and skill >= 7: is_yellow = True
-            elif group == 3 and skill == 3: is_yellow = True
-        else:
-            if group == 1 and skill >= 2: is_yellow = True
-            elif group == 2 and skill == 0: is_yellow = True
-            elif group == 3 and skill <= 1: is_yellow = True
-            
-        if is_yellow:
-            formats[i] = {"bg": {"red": 1.0, "green": 0.95, "blue": 0.8}, "bold": False}
-            continue
+    skill = block["_skill_num"].fillna(0).to_numpy()
+    group = block["_group_num"].fillna(99).to_numpy()
+    is_advanced = block["_is_advanced"].eq(True).to_numpy()
 
-    # 2. GREEN RULE (Move Up)
-    def apply_green_recursive(indices):
-        if not indices: return
-        for idx in reversed(indices):
-            row_comment = str(df_records[idx].get("RS Comment", "")).lower()
-            if "ignore" in row_comment: continue
-            
+    # 1. BASE RULES
+    # RED TEXT (Bold + Red Text)
+    red = ~skip & ~is_advanced & (skill >= 3)
+    # LIGHT RED BG (Blank Group)
+    light_red = ~skip & ~red & (group == 99)
+    # YELLOW BG
+    yellow_advanced = is_advanced & (
+        ((group == 1) & (skill >= 5)) | ((group == 2) & (skill >= 7)) | ((group == 3) & (skill == 3))
+    )
+    yellow_regular = ~is_advanced & (
+        ((group == 1) & (skill >= 2)) | ((group == 2) & (skill == 0)) | ((group == 3) & (skill <= 1))
+    )
+    yellow = ~skip & ~red & ~light_red & (yellow_advanced | yellow_regular)
+
+    formats = np.full(len(block), None, dtype=object)
+    formats[red] = RED_FMT
+    formats[light_red] = LIGHT_RED_FMT
+    formats[yellow] = YELLOW_FMT
+    formats = formats.tolist()
+
+    # 2. GREEN RULE (Move Up): last eligible unformatted row of groups 1 and 2
+    for grp_num in (1, 2):
+        for idx in reversed(np.flatnonzero(group == grp_num)):
             # Skip "open" rows for green highlighting logic
-            if df_records[idx].get("Student Name") == "open": continue
-
+            if ignore[idx] or is_open[idx]: continue
             if formats[idx] is None:
-                formats[idx] = {"bg": {"red": 0.85, "green": 0.92, "blue": 0.83}, "bold": False}
-                break 
-
-    group_1_indices = [i for i, r in enumerate(df_records) if parse_group_number(r.get("Keyword", "")) == 1]
-    group_2_indices = [i for i, r in enumerate(df_records) if parse_group_number(r.get("Keyword", "")) == 2]
-
-    apply_green_recursive(group_1_indices)
-    apply_green_recursive(group_2_indices)
+                formats[idx] = GREEN_FMT
+                break
 
     return formats
 
-def update_google_sheet_advanced(full_df):
-    if "gcp_service_account" not in st.secrets:
-        st.error("Secrets not found!")
-        return None
+class _SheetsRetry(Retry):
+    """Retries 429s on any call but 5xx only on reads; a write may already have been applied."""
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code != 429 and method.upper() != "GET":
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
 
+@st.cache_resource(show_spinner=False)
+def get_gspread_client():
+    """Authorized client, reused across reruns so the token exchange happens once."""
     creds_dict = st.secrets["gcp_service_account"]
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-
-    try:
-        ss = client.open(GOOGLE_SHEET_NAME)
-    except Exception as e:
-        st.error(f"Could not open sheet: {e}")
-        return None
-
+    client = gspread.service_account_from_dict(dict(creds_dict), scopes=scope)
+    # One keep-alive session for every call. Failed connects, 429s and 5xx on reads get up to
+    # 3 retries (about 2 s of backoff): enough for a blip, not for a per-minute write quota, so a
+    # sustained 429 still surfaces as an API error. Read errors may follow an applied request
+    retry = _SheetsRetry(
+        total=3, read=0, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None, raise_on_status=False
+    )
+    client.http_client.session.mount("https://", HTTPAdapter(max_retries=retry))
+    return client
+
+@st.cache_resource(show_spinner=False)
+def open_spreadsheet(name):
+    """Looks the spreadsheet up by name once; failures are not cached."""
+    return get_gspread_client().open(name)
+
+def build_day_layouts(full_df):
+    """
+    Lays out one tab per day as (day, cell values, formats per slot,
+    border ranges per slot). Days without students are left out.
+    """
     full_df = full_df.rename(columns={
         "Attendance": "Attend#",
         "Student Keyword": "Keyword",
@@ -266,123 +328,142 @@ def update_google_sheet_advanced(full_df):
         "Roll Sheet Comment": "RS Comment"
     })
 
-    days_order = ["Mon", "Tue", "Wed", "Thu", "Fri", "Lost"]
-    export_cols = ["Student Name", "Age", "Attend#", "Keyword", "Level", "Class Name", "RS Comment"]
+    # One stable sort for the in-group order; every slot/group slice below keeps it
+    full_df = full_df.sort_values(by=['_skill_num', '_att_num', '_age_num'], kind='stable')
 
-    try:
-        sheet1 = ss.worksheet("Sheet1")
-        ss.del_worksheet(sheet1)
-    except: pass
-
-    for day in days_order:
-        if day == "Lost":
-            day_df = full_df[full_df["Sort Day"] == "Lost"].copy()
-        else:
-            day_df = full_df[full_df["Sort Day"] == day].copy()
-            
-        if day_df.empty: continue
+    # Partition once by day and by time slot instead of masking per tab/slot;
+    # Sort Day is categorical in tab order and days without students are skipped
+    layouts = []
 
-        try:
-            old_ws = ss.worksheet(day)
-            ss.del_worksheet(old_ws)
-        except: pass 
-
-        unique_times = sorted(day_df['Sort Time'].unique())
+    for day, day_df in full_df.groupby("Sort Day", observed=True, sort=True):
+        time_groups = list(day_df.groupby('Sort Time', sort=True))
+        unique_times = [time_slot for time_slot, _ in time_groups]
         slot_data_map = {}
         slot_format_map = {}
         slot_border_ranges = {} 
         max_rows = 0
         
         # --- BUILD STRUCTURE PER TIME SLOT ---
-        for i, time_slot in enumerate(unique_times):
-            time_df = day_df[day_df['Sort Time'] == time_slot].copy()
+        for i, (time_slot, time_df) in enumerate(time_groups):
             
-            def get_sorted_group(grp_num):
-                mask = time_df['Keyword'].apply(lambda x: parse_group_number(x) == grp_num)
-                grp_df = time_df[mask].copy()
-                grp_df['sort_skill'] = grp_df['Level'].apply(parse_skill_number)
-                grp_df['sort_att'] = grp_df['Attend#'].apply(parse_attendance)
-                grp_df['sort_age'] = grp_df['Age'].apply(parse_age)
-                return grp_df.sort_values(by=['sort_skill', 'sort_att', 'sort_age'], ascending=[True, True, True])
-
-            g1 = get_sorted_group(1)
-            g2 = get_sorted_group(2)
-            g3 = get_sorted_group(3)
-            g_other = time_df[~time_df.index.isin(g1.index.union(g2.index).union(g3.index))].copy()
-
-            final_records = []
+            g1 = time_df[time_df['_group_num'] == 1]
+            g2 = time_df[time_df['_group_num'] == 2]
+            g3 = time_df[time_df['_group_num'] == 3]
+            # Students without a group stay in student-list order
+            g_other = time_df[~time_df['_group_num'].isin([1, 2, 3])].sort_index()
+
+            # Each group: open rows up to 7, then its students, then a blank spacer row
+            pieces = []
             border_ranges = []
-            
-            def add_group_block(df_group, label_num):
-                nonlocal final_records, border_ranges
-                rows = df_group.to_dict('records')
-                count = len(rows)
-                needed = max(0, 7 - count)
-                
-                open_rows = []
-                for _ in range(needed):
-                    open_rows.append({
-                        "Student Name": "open", "Age": "", "Attend#": "", 
-                        "Keyword": "", "Level": "", "Class Name": "", "RS Comment": ""
-                    })
-                
-                block = open_rows + rows
-                start_idx = len(final_records) 
-                end_idx = start_idx + len(block) - 1
-                border_ranges.append((start_idx, end_idx))
-                final_records.extend(block)
-                spacer = {c: "" for c in export_cols}
-                final_records.extend([spacer])
-
-            add_group_block(g1, 1)
-            add_group_block(g2, 2)
-            add_group_block(g3, 3)
-            
+            row_count = 0
+            for df_group in (g1, g2, g3):
+                needed = max(0, 7 - len(df_group))
+                block_len = needed + len(df_group)
+                border_ranges.append((row_count, row_count + block_len - 1))
+                if needed: pieces.append(OPEN_ROWS.iloc[:needed])
+                if not df_group.empty: pieces.append(df_group)
+                pieces.append(SPACER_ROW)
+                row_count += block_len + 1
+
             if not g_other.empty:
-                final_records.extend(g_other.to_dict('records'))
+                pieces.append(g_other)
 
-            formats_list = apply_highlight_rules(final_records)
-            slot_format_map[i] = formats_list
+            final_block = pd.concat(pieces, ignore_index=True)
+            slot_format_map[i] = apply_highlight_rules(final_block)
             slot_border_ranges[i] = border_ranges
-            
-            final_block = pd.DataFrame(final_records)
-            if final_block.empty: final_block = pd.DataFrame(columns=export_cols)
-            else: final_block = final_block[export_cols]
+            final_block = final_block[EXPORT_COLS]
 
-            slot_data_map[i] = final_block
+            # Plain cell values for the grid; indexing the frame per row builds a Series each time
+            slot_data_map[i] = final_block.to_numpy(dtype=object)
             if len(final_block) > max_rows: max_rows = len(final_block)
 
         # --- GRID CONSTRUCTION ---
-        headers = []
-        for _ in unique_times:
-            headers.extend(export_cols)
-            headers.append("") 
-        
-        final_values = [headers]
-        
-        for r in range(max_rows):
-            row_data = []
-            for i in range(len(unique_times)):
-                df = slot_data_map[i]
-                if r < len(df):
-                    row_data.extend(df.iloc[r][export_cols].tolist())
-                else:
-                    row_data.extend([""] * len(export_cols))
-                row_data.append("")
-            final_values.append(row_data)
-
-        total_cols = max(len(unique_times) * 8, 26) 
+        # Slots sit side by side, each followed by one blank column
+        slot_width = len(EXPORT_COLS) + 1
+        grid = np.full((max_rows + 1, len(unique_times) * slot_width), "", dtype=object)
+        for i in range(len(unique_times)):
+            col_start = i * slot_width
+            grid[0, col_start:col_start + len(EXPORT_COLS)] = EXPORT_COLS
+            slot_values = slot_data_map[i]
+            grid[1:1 + len(slot_values), col_start:col_start + len(EXPORT_COLS)] = slot_values
+        final_values = grid.tolist()
+
+        layouts.append((day, final_values, slot_format_map, slot_border_ranges))
+
+    return layouts
+
+def update_google_sheet_advanced(full_df):
+    if "gcp_service_account" not in st.secrets:
+        st.error("Secrets not found!")
+        return None
+
+    try:
+        ss = open_spreadsheet(GOOGLE_SHEET_NAME)
+    except Exception as e:
+        st.error(f"Could not open sheet: {e}")
+        return None
+
+    layouts = build_day_layouts(full_df)
+    day_pos = {day: pos for pos, (day, *_) in enumerate(layouts)}
+
+    # Old day tabs and the default Sheet1 are replaced
+    try:
+        existing = ss.worksheets()
+    except gspread.exceptions.APIError:
+        # The cached handle may point at a deleted or unshared sheet; look it up again next time
+        open_spreadsheet.clear()
+        raise
+    stale = [ws for ws in existing if ws.title == "Sheet1" or ws.title in day_pos]
+    keeper = None
+    if stale and len(stale) == len(existing):
+        # The API refuses to remove every tab; one stays until the new tabs exist,
+        # preferably one that is not rewritten
+        keeper = max(stale, key=lambda ws: day_pos.get(ws.title, len(day_pos)))
+        stale.remove(keeper)
+
+    # Everything goes out in one batch_update, applied in order: old tabs out,
+    # new tabs in with their values, then formatting and the auto-fit
+    requests = [{"deleteSheet": {"sheetId": ws.id}} for ws in stale]
+    if keeper is not None and keeper.title in day_pos:
+        # A kept day tab is renamed so its replacement can take the title
+        requests.append({
+            "updateSheetProperties": {
+                "properties": {"sheetId": keeper.id, "title": f"_old_{keeper.id}"},
+                "fields": "title"
+            }
+        })
+    format_requests = []
+    next_id = max((ws.id for ws in existing), default=0) + 1
+
+    for pos, (day, final_values, slot_format_map, slot_border_ranges) in enumerate(layouts):
+        n_slots = len(slot_format_map)
+        total_cols = max(n_slots * 8, 26) 
         total_rows = len(final_values) + 20 
-        ws = ss.add_worksheet(title=day, rows=total_rows, cols=total_cols)
-        ws.update(range_name="A1", values=final_values)
-        
-        requests = []
+        sheet_id = next_id + pos
+        requests.append({
+            "addSheet": {
+                "properties": {
+                    "sheetId": sheet_id, "title": day,
+                    "gridProperties": {"rowCount": total_rows, "columnCount": total_cols}
+                }
+            }
+        })
+        requests.append({
+            "updateCells": {
+                "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                "rows": [
+                    {"values": [{"userEnteredValue": {"stringValue": v}} if v != "" else {} for v in row]}
+                    for row in final_values
+                ],
+                "fields": "userEnteredValue"
+            }
+        })
         
         # 1. BOLD HEADERS
-        requests.append({
+        format_requests.append({
             "repeatCell": {
                 "range": {
-                    "sheetId": ws.id, "startRowIndex": 0, "endRowIndex": 1,
+                    "sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1,
                     "startColumnIndex": 0, "endColumnIndex": total_cols
                 },
                 "cell": {"userEnteredFormat": {"textFormat": {"bold": True}}},
@@ -392,11 +473,15 @@ def update_google_sheet_advanced(full_df):
         
         # 2. FORMATTING & BORDERS
         current_col_start = 0
-        for i in range(len(unique_times)):
+        for i in range(n_slots):
             formats = slot_format_map[i]
-            for row_idx, fmt in enumerate(formats):
+            # Consecutive rows with the same format share one request
+            run_start = 0
+            for fmt, run in groupby(formats):
+                run_len = len(list(run))
+                sheet_row_index = run_start + 1
+                run_start += run_len
                 if fmt:
-                    sheet_row_index = row_idx + 1 
                     cell_format = {}
                     fields_list = []
                     
@@ -413,12 +498,12 @@ def update_google_sheet_advanced(full_df):
                         fields_list.append("userEnteredFormat.textFormat")
 
                     if fields_list:
-                        requests.append({
+                        format_requests.append({
                             "repeatCell": {
                                 "range": {
-                                    "sheetId": ws.id,
-                                    "startRowIndex": sheet_row_index, "endRowIndex": sheet_row_index + 1,
-                                    "startColumnIndex": current_col_start, "endColumnIndex": current_col_start + len(export_cols)
+                                    "sheetId": sheet_id,
+                                    "startRowIndex": sheet_row_index, "endRowIndex": sheet_row_index + run_len,
+                                    "startColumnIndex": current_col_start, "endColumnIndex": current_col_start + len(EXPORT_COLS)
                                 },
                                 "cell": {"userEnteredFormat": cell_format},
                                 "fields": ",".join(fields_list)
@@ -430,14 +515,14 @@ def update_google_sheet_advanced(full_df):
                 sheet_start_row = start_r + 1 
                 sheet_end_row = end_r + 2 
                 
-                requests.append({
+                format_requests.append({
                     "updateBorders": {
                         "range": {
-                            "sheetId": ws.id,
+                            "sheetId": sheet_id,
                             "startRowIndex": sheet_start_row,
                             "endRowIndex": sheet_end_row,
                             "startColumnIndex": current_col_start,
-                            "endColumnIndex": current_col_start + len(export_cols)
+                            "endColumnIndex": current_col_start + len(EXPORT_COLS)
                         },
                         "top": {"style": "SOLID", "width": 1},
                         "bottom": {"style": "SOLID", "width": 1},
@@ -446,20 +531,79 @@ def update_google_sheet_advanced(full_df):
                     }
                 })
 
-            current_col_start += (len(export_cols) + 1)
+            current_col_start += (len(EXPORT_COLS) + 1)
 
         # 3. Auto-Fit
-        requests.append({
+        format_requests.append({
             "autoResizeDimensions": {
-                "dimensions": {"sheetId": ws.id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": total_cols}
+                "dimensions": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": total_cols}
             }
         })
 
-        if requests:
+    # The kept-back tab goes once the new tabs exist
+    if keeper is not None and layouts:
+        format_requests.append({"deleteSheet": {"sheetId": keeper.id}})
+
+    requests.extend(format_requests)
+    if requests:
+        try:
             ss.batch_update({"requests": requests})
+        except gspread.exceptions.APIError:
+            open_spreadsheet.clear()
+            raise
 
     return f"https://docs.google.com/spreadsheets/d/{ss.id}"
 
+def _argb(color):
+    return "FF" + "".join(f"{round(color[c] * 255):02X}" for c in ("red", "green", "blue"))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_workbook(full_df):
+    """Same day tabs as the Google Sheet, as .xlsx bytes built without any API calls."""
+    wb = Workbook()
+    wb.remove(wb.active)
+    side = Side(style="thin")
+
+    for day, final_values, slot_format_map, slot_border_ranges in build_day_layouts(full_df):
+        ws = wb.create_sheet(title=day)
+        for row in final_values:
+            ws.append([v if v != "" else None for v in row])
+        for cell in ws[1]:
+            cell.font = Font(bold=True)
+
+        col_start = 1
+        for i in range(len(slot_format_map)):
+            cols = range(col_start, col_start + len(EXPORT_COLS))
+            for row_idx, fmt in enumerate(slot_format_map[i]):
+                if not fmt: continue
+                fill = PatternFill("solid", fgColor=_argb(fmt["bg"])) if "bg" in fmt else None
+                font = Font(bold=fmt.get("bold", False), color=_argb(fmt["text_color"]) if "text_color" in fmt else None)
+                for c in cols:
+                    cell = ws.cell(row=row_idx + 2, column=c)
+                    cell.font = font
+                    if fill: cell.fill = fill
+
+            # Box around each group block, like updateBorders on the sheet
+            for start_r, end_r in slot_border_ranges[i]:
+                for r in range(start_r + 2, end_r + 3):
+                    for c in cols:
+                        ws.cell(row=r, column=c).border = Border(
+                            top=side if r == start_r + 2 else None,
+                            bottom=side if r == end_r + 2 else None,
+                            left=side if c == cols[0] else None,
+                            right=side if c == cols[-1] else None,
+                        )
+
+            col_start += len(EXPORT_COLS) + 1
+
+        for column in ws.columns:
+            lengths = [len(str(cell.value)) for cell in column if cell.value is not None]
+            if lengths: ws.column_dimensions[column[0].column_letter].width = max(lengths) + 2
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
 
 # --- MAIN UI ---
 st.title("🥷 Ninja Park Data Processor 3.9")
@@ -472,11 +616,10 @@ with col2:
     file_2 = st.file_uploader("Upload File B", type=['html', 'htm'])
 
 if file_1 and file_2:
-    file_1.seek(0)
-    file_2.seek(0)
-    
-    content_1 = file_1.read().decode("utf-8", errors='ignore')
-    content_2 = file_2.read().decode("utf-8", errors='ignore')
+    # getvalue() hands back the whole upload without touching the read position;
+    # the raw bytes are both the parse input and the parse cache key
+    content_1 = file_1.getvalue()
+    content_2 = file_2.getvalue()
     
     # SMART DETECTION
     type_1 = identify_file_type(content_1)
@@ -504,21 +647,19 @@ if file_1 and file_2:
                 if df_roll.empty: st.warning("⚠️ No data in Roll Sheet.")
                 if df_list.empty: st.warning("⚠️ No data in Student List.")
 
-                merged_df = pd.merge(df_list, df_roll, on="Student Name", how="left")
-                merged_df = merged_df[merged_df["Student Name"].str.strip().astype(bool)]
-                
-                merged_df["Skill Level"] = merged_df["Skill Level"].fillna("s0")
-                merged_df["Class Name"] = merged_df["Class Name"].fillna("Not Found")
-                
-                merged_df["Class Name"] = merged_df["Class Name"].apply(abbreviate_class_name)
-                
-                merged_df[['Sort Day', 'Sort Time', 'Time Str']] = merged_df['Class Name'].apply(
-                    lambda x: pd.Series(parse_class_info(x))
-                )
-
-                merged_df.loc[merged_df['Sort Day'] == "Lost", 'Sort Day'] = "Lost"
+                merged_df = build_student_table(df_list, df_roll)
 
                 st.success(f"Processed {len(merged_df)} students.")
+
+                # Local copy of the dashboard; no Google API round-trips. The
+                # workbook is only built when the button is clicked
+                if not merged_df.empty:
+                    st.download_button(
+                        "Download Excel Copy", data=lambda: build_workbook(merged_df),
+                        file_name=f"{GOOGLE_SHEET_NAME}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        use_container_width=True
+                    )
                 
                 if st.button("Update Master Google Sheet", use_container_width=True):
                     link = update_google_sheet_advanced(merged_df)